@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+_SOBEL_X = torch.tensor([[-1., 0., 1.],
+                         [-2., 0., 2.],
+                         [-1., 0., 1.]]).view(1, 1, 3, 3)
+_SOBEL_Y = torch.tensor([[-1., -2., -1.],
+                         [0., 0., 0.],
+                         [1., 2., 1.]]).view(1, 1, 3, 3)
+
+
+def canny_batch(gray_images, lower_threshold=100, upper_threshold=200, device=None):
+    # Canny over a whole (N, H, W) uint8 stack with batched convolutions:
+    # Sobel gradients, non-maximum suppression along the quantized gradient
+    # direction, double threshold and dilation-based hysteresis. One kernel
+    # launch per stage instead of one cv2.Canny call per image.
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    t = torch.from_numpy(np.ascontiguousarray(gray_images)).to(device=device, dtype=torch.float32)
+    t = t.unsqueeze(1)
+    n, _, height, width = t.shape
+
+    padded = F.pad(t, (1, 1, 1, 1), mode='replicate')
+    grad_x = F.conv2d(padded, _SOBEL_X.to(device))
+    grad_y = F.conv2d(padded, _SOBEL_Y.to(device))
+    magnitude = grad_x.abs() + grad_y.abs()
+
+    # Quantize the gradient direction to 0/45/90/135 degrees
+    sector = torch.round(torch.atan2(grad_y, grad_x) / (math.pi / 4)) % 4
+
+    mag_padded = F.pad(magnitude, (1, 1, 1, 1))
+
+    def shifted(dy, dx):
+        return mag_padded[..., 1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+
+    # The two neighbors along the gradient for each direction sector
+    neighbor_a = torch.where(sector == 0, shifted(0, 1),
+                             torch.where(sector == 1, shifted(-1, 1),
+                                         torch.where(sector == 2, shifted(-1, 0), shifted(-1, -1))))
+    neighbor_b = torch.where(sector == 0, shifted(0, -1),
+                             torch.where(sector == 1, shifted(1, -1),
+                                         torch.where(sector == 2, shifted(1, 0), shifted(1, 1))))
+    is_ridge = (magnitude >= neighbor_a) & (magnitude >= neighbor_b)
+
+    strong = is_ridge & (magnitude > upper_threshold)
+    weak = is_ridge & (magnitude > lower_threshold)
+
+    # Hysteresis: grow strong edges into connected weak pixels until stable
+    strong = strong.float()
+    weak = weak.float()
+    while True:
+        grown = torch.clamp(F.max_pool2d(strong, 3, stride=1, padding=1), max=1) * weak
+        grown = torch.maximum(strong, grown)
+        if torch.equal(grown, strong):
+            break
+        strong = grown
+
+    return (strong.squeeze(1) * 255).to(torch.uint8).cpu().numpy()
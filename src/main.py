@@ -1,13 +1,39 @@
 # Import necessary libraries
 
 import numpy as np
+import matplotlib
+# Workers render straight to files; pin the backend before pyplot is imported
+# so no process pays for interactive-backend setup
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import PatchCollection
 import os
 import cv2
 import itertools
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 
-from src.plot import plot_images
+from scipy.spatial.distance import pdist, squareform
+from sklearn.metrics import silhouette_score
+
+from joblib import Parallel, delayed
+
+_rng = np.random.default_rng()
+
+# Figure reused across train_and_visualize calls within a worker process
+_figure = None
+
+try:
+    from src.canny import canny_batch
+    _HAVE_TORCH = True
+except ImportError:
+    _HAVE_TORCH = False
+
+try:
+    from numba import njit, prange
+    _HAVE_NUMBA = True
+except ImportError:
+    prange = range
+    _HAVE_NUMBA = False
 
 
 def unpickle(file):
@@ -17,33 +43,109 @@ def unpickle(file):
     return dict
 
 def load_and_preprocess_data(data_dir):
-    car_images = []
-    edge_images = []
-    labels = []
-
-    for batch in range(1, 6):
-        file = os.path.join(data_dir, 'data_batch_' + str(batch))
-        with open(file, 'rb') as fo:
-            batch_data = unpickle(file)
-            for i in range(len(batch_data[b'labels'])):
-                if batch_data[b'labels'][i] == 1 or batch_data[b'labels'][i] == 9:  # labels for cars and trucks
-                    image = np.reshape(batch_data[b'data'][i], (3, 32, 32)).transpose(1, 2, 0)
-                    car_images.append(image)
-                    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                    edge_image = cv2.Canny(gray_image, 100, 200)
-                    edge_images.append(edge_image)
-                    labels.append(batch_data[b'labels'][i])
-
-    # Convert to numpy arrays and return
-    return np.array(car_images), np.array(edge_images), np.array(labels)
-
-
-def extract_features_from_edge_image(edge_image):
-    mean_intensity = np.mean(edge_image)
-    white_pixel_count = np.sum(edge_image > 0)
-    std_dev = np.std(edge_image)
-    white_pixel_ratio = white_pixel_count / (edge_image.shape[0] * edge_image.shape[1])
-    return [mean_intensity, white_pixel_count, std_dev, white_pixel_ratio]
+    batch_files = [os.path.join(data_dir, 'data_batch_' + str(batch)) for batch in range(1, 6)]
+
+    # First pass: count car/truck rows so the outputs can be written in place
+    total = 0
+    for file in batch_files:
+        batch_labels = np.array(unpickle(file)[b'labels'])
+        total += int(np.isin(batch_labels, (1, 9)).sum())
+
+    car_images = np.empty((total, 32, 32, 3), dtype=np.uint8)
+    edge_images = np.empty((total, 32, 32), dtype=np.uint8)
+    labels = np.empty(total, dtype=np.int32)
+
+    # Second pass: fill each batch's slice directly, no list growth plus
+    # np.array copy at the end
+    offset = 0
+    for file in batch_files:
+        batch_data = unpickle(file)
+        batch_labels = np.array(batch_data[b'labels'])
+        mask = np.isin(batch_labels, (1, 9))  # labels for cars and trucks
+        count = int(mask.sum())
+        block = slice(offset, offset + count)
+
+        car_images[block] = batch_data[b'data'][mask].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+        labels[block] = batch_labels[mask]
+
+        # Batched grayscale with the same channel weights cv2.cvtColor applies
+        images = car_images[block]
+        gray = np.rint(0.114 * images[..., 0] + 0.587 * images[..., 1]
+                       + 0.299 * images[..., 2]).astype(np.uint8)
+        if _HAVE_TORCH:
+            # One batched kernel over the whole stack (GPU when available)
+            edge_images[block] = canny_batch(gray, lower_threshold=100, upper_threshold=200)
+        else:
+            # OpenCV has no batch Canny, so keep the loop but write each result
+            # straight into the preallocated slice
+            for i in range(count):
+                edge_images[offset + i] = cv2.Canny(gray[i], 100, 200)
+
+        offset += count
+
+    return car_images, edge_images, labels
+
+
+def extract_features_from_edge_images(edge_images):
+    flat = edge_images.reshape(edge_images.shape[0], -1)
+    mean_intensity = flat.mean(axis=1)
+    white_pixel_count = (flat > 0).sum(axis=1)
+    std_dev = flat.std(axis=1)
+    white_pixel_ratio = white_pixel_count / flat.shape[1]
+    return np.stack([mean_intensity, white_pixel_count, std_dev, white_pixel_ratio], axis=1)
+
+def _train_online_epoch(weights, data, learning_rate, radius):
+    # JIT-compiled hot loop for one online epoch: BMU search plus neighborhood
+    # update per sample, without NumPy dispatch overhead
+    map_h, map_w, input_dim = weights.shape
+    radius_sq = radius * radius
+    for n in range(data.shape[0]):
+        best = np.inf
+        win_x = 0
+        win_y = 0
+        for i in range(map_h):
+            for j in range(map_w):
+                dist = 0.0
+                for k in range(input_dim):
+                    diff = weights[i, j, k] - data[n, k]
+                    dist += diff * diff
+                if dist < best:
+                    best = dist
+                    win_x = i
+                    win_y = j
+        for i in prange(map_h):
+            for j in range(map_w):
+                dist_sq = (i - win_x) ** 2 + (j - win_y) ** 2
+                if dist_sq <= radius_sq:
+                    influence = learning_rate * np.exp(-dist_sq / (2 * radius_sq))
+                    for k in range(input_dim):
+                        weights[i, j, k] += influence * (data[n, k] - weights[i, j, k])
+
+
+if _HAVE_NUMBA:
+    _train_online_epoch = njit(parallel=True, fastmath=True, cache=True)(_train_online_epoch)
+
+
+def _bmu_d4(weights_flat, input_vector):
+    # BMU search specialized to the 4-feature case used throughout
+    # main_parallel; the whole map fits in L1, so the hot loop is four
+    # fused multiply-adds plus a running min per neuron
+    best = np.inf
+    best_index = 0
+    for k in range(weights_flat.shape[0]):
+        dist = ((weights_flat[k, 0] - input_vector[0]) ** 2
+                + (weights_flat[k, 1] - input_vector[1]) ** 2
+                + (weights_flat[k, 2] - input_vector[2]) ** 2
+                + (weights_flat[k, 3] - input_vector[3]) ** 2)
+        if dist < best:
+            best = dist
+            best_index = k
+    return best_index
+
+
+if _HAVE_NUMBA:
+    _bmu_d4 = njit(cache=True, fastmath=True)(_bmu_d4)
+
 
 class SOM:
     def __init__(self, input_dim, map_size, data, learning_rate=0.5, radius=1.0):
@@ -51,55 +153,129 @@ class SOM:
         self.map_size = map_size
         self.learning_rate = learning_rate
         self.radius = radius
-        self.weights = np.random.rand(map_size[0], map_size[1], self.input_dim)
+        # float32 halves the memory traffic of the bandwidth-bound updates and
+        # keeps the batch BMU matrix product on the single-precision BLAS path
+        self.weights = np.random.rand(map_size[0], map_size[1], self.input_dim).astype(np.float32)
+        # Squared grid distance between every neuron pair, computed once per
+        # instance (~0.6 MB at float32 for a 20x20 map); the neighborhood of a
+        # winner is then a single index plus exp. Scratch buffer keeps the
+        # per-sample update allocation-free.
+        grid_x, grid_y = np.indices(map_size, dtype=np.float32)
+        coords = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+        pairwise = ((coords[:, None, :] - coords[None, :, :]) ** 2).sum(axis=2)
+        self._pairwise_dist_sq = pairwise.reshape(map_size[0], map_size[1], map_size[0], map_size[1])
+        self._scratch = np.empty(map_size, dtype=np.float32)
+        if data is not None and self.input_dim >= 2:
+            self._init_weights_pca(np.asarray(data, dtype=np.float32))
+
+    def _init_weights_pca(self, data):
+        # Spread the initial map along the top two principal axes of the data,
+        # so training starts near the data plane instead of random noise
+        mean = data.mean(axis=0)
+        centered = data - mean
+        eigenvalues, eigenvectors = np.linalg.eigh(centered.T.dot(centered))
+        # eigh sorts ascending; take the two dominant components, scaled by
+        # the standard deviation along each axis
+        scales = np.sqrt(np.maximum(eigenvalues[::-1][:2], 0) / data.shape[0])
+        axis_major = scales[0] * eigenvectors[:, -1]
+        axis_minor = scales[1] * eigenvectors[:, -2]
+        pos_x = np.linspace(-1, 1, self.map_size[0])
+        pos_y = np.linspace(-1, 1, self.map_size[1])
+        self.weights = (mean
+                        + pos_x[:, None, None] * axis_major
+                        + pos_y[None, :, None] * axis_minor).astype(np.float32)
 
     def _calculate_distance(self, x, y):
         return np.linalg.norm(x - y)
 
     def _find_winner(self, input_vector):
+        if _HAVE_NUMBA and self.input_dim == 4:
+            input_vector = np.ascontiguousarray(input_vector, dtype=self.weights.dtype)
+            index = _bmu_d4(self.weights.reshape(-1, 4), input_vector)
+            return np.unravel_index(index, self.map_size)
         distances = np.linalg.norm(self.weights - input_vector, axis=2)
         return np.unravel_index(distances.argmin(), distances.shape)
 
-    def _update_weights(self, input_vector, winner_coords):
-        # Calculate the distance from each neuron to the winner
-        x = np.arange(self.map_size[0])
-        y = np.arange(self.map_size[1])
-        dist_x, dist_y = np.meshgrid(x, y)
-        dist_to_winner = np.sqrt((dist_x - winner_coords[0]) ** 2 + (dist_y - winner_coords[1]) ** 2)
+    def find_winners_batch(self, data):
+        # BMUs for all input vectors at once: expand ||x - w||^2 so the cross
+        # term becomes one matrix product instead of N broadcasts
+        flat_weights = self.weights.reshape(-1, self.input_dim)
+        dist_sq = ((data * data).sum(axis=1, keepdims=True)
+                   + (flat_weights * flat_weights).sum(axis=1)
+                   - 2 * data.dot(flat_weights.T))
+        winners = dist_sq.argmin(axis=1)
+        return np.stack(np.unravel_index(winners, self.map_size), axis=1)
 
-        # Only consider neurons within the given radius
-        mask = dist_to_winner <= self.radius
+    def _update_weights(self, input_vector, winner_coords):
+        # Squared distance from each neuron to the winner is a cached lookup
+        dist_sq = self._pairwise_dist_sq[winner_coords[0], winner_coords[1]]
 
-        # Calculate the influence
-        influence = np.exp(-dist_to_winner / (2 * (self.radius ** 2)))
-        influence = influence * mask
+        # Gaussian influence, limited to neurons within the given radius,
+        # computed in-place in the scratch buffer
+        mask = dist_sq <= self.radius ** 2
+        influence = self._scratch
+        np.multiply(dist_sq, -1 / (2 * (self.radius ** 2)), out=influence)
+        np.exp(influence, out=influence)
+        influence *= mask
 
-        # Update weights for the influenced neurons
-        delta = input_vector - self.weights
-        for i in range(self.weights.shape[2]):
-            self.weights[:, :, i] += self.learning_rate * influence * delta[:, :, i]
+        # Single broadcasted update over the whole map
+        self.weights += self.learning_rate * influence[:, :, None] * (input_vector - self.weights)
 
-    def train(self, data, epochs):
+    def train(self, data, epochs, checkpoint_epochs=None):
         initial_lr = self.learning_rate
         initial_radius = self.radius
+        data = np.ascontiguousarray(data, dtype=self.weights.dtype)
+        checkpoints = set(checkpoint_epochs) if checkpoint_epochs else set()
+        snapshots = {}
         for epoch in range(epochs):
             self.learning_rate = initial_lr * (1 - epoch / float(epochs))
             self.radius = initial_radius * (1 - epoch / float(epochs))
-            for input_vector in data:
-                winner_coords = self._find_winner(input_vector)
-                self._update_weights(input_vector, winner_coords)
+            if _HAVE_NUMBA:
+                _train_online_epoch(self.weights, data, self.learning_rate, self.radius)
+            else:
+                for input_vector in data:
+                    winner_coords = self._find_winner(input_vector)
+                    self._update_weights(input_vector, winner_coords)
+            if (epoch + 1) in checkpoints:
+                snapshots[epoch + 1] = self.weights.copy()
+        if checkpoint_epochs is not None:
+            return snapshots
+
+    def train_batch(self, data, epochs):
+        # Offline Kohonen update: per epoch find all BMUs at once, then replace
+        # the weights with the neighborhood-weighted mean of the data
+        n_neurons = self.map_size[0] * self.map_size[1]
+        pairwise_dist_sq = self._pairwise_dist_sq.reshape(n_neurons, n_neurons)
+        initial_radius = self.radius
+        for epoch in range(epochs):
+            radius = initial_radius * (1 - epoch / float(epochs))
+            winners = self.find_winners_batch(data)
+            winners_flat = winners[:, 0] * self.map_size[1] + winners[:, 1]
+            dist_sq = pairwise_dist_sq[winners_flat]
+            neighborhood = np.exp(-dist_sq / (2 * (radius ** 2)))
+            neighborhood = neighborhood * (dist_sq <= radius ** 2)
+            numerator = neighborhood.T.dot(data)
+            denominator = neighborhood.sum(axis=0)[:, None]
+            flat_weights = self.weights.reshape(-1, self.input_dim)
+            new_weights = numerator / np.where(denominator > 0, denominator, 1)
+            # Neurons outside every sample's neighborhood keep their weights
+            new_weights = np.where(denominator > 0, new_weights, flat_weights)
+            self.weights = new_weights.reshape(self.map_size[0], self.map_size[1], self.input_dim)
 
 
 def visualize_som_clusters(cluster_centers, samples, ax):
-    for center in cluster_centers:
-        ax.scatter(center[0], center[1], color='black', s=100)
-
-        # Find the distance to the nearest other cluster center to set the influence radius
-        other_centers = [c for c in cluster_centers if not np.array_equal(c, center)]
-        distances = [np.linalg.norm(center - c) for c in other_centers]
-        influence_radius = min(distances) / 2
-        circle = plt.Circle((center[0], center[1]), radius=influence_radius, color='red', fill=False)
-        ax.add_artist(circle)
+    # Distance to the nearest other cluster center, for all centers at once,
+    # sets the influence radii
+    center_distances = squareform(pdist(cluster_centers))
+    np.fill_diagonal(center_distances, np.inf)
+    influence_radii = center_distances.min(axis=1) / 2
+
+    # One scatter call for all centers and one collection for all circles
+    # instead of one dispatch per neuron
+    ax.scatter(cluster_centers[:, 0], cluster_centers[:, 1], color='black', s=100)
+    circles = [plt.Circle((center[0], center[1]), radius=influence_radius)
+               for center, influence_radius in zip(cluster_centers, influence_radii)]
+    ax.add_collection(PatchCollection(circles, facecolors='none', edgecolors='red'))
 
     # Plotting samples
     ax.scatter(samples[:, 0], samples[:, 1], color='blue', s=30, label='Punkt danych')
@@ -112,18 +288,29 @@ def visualize_som_clusters(cluster_centers, samples, ax):
     ax.legend(loc='upper right')
     ax.grid(True)
 
-def train_and_visualize(params):
-    input_dim, map_size, feature_vectors, learning_rate, radius, epochs, output_directory = params
+def compute_silhouette_score(som, data):
+    # Cluster label per sample is its flattened BMU index, computed for the
+    # whole dataset in one batch pass
+    winners = som.find_winners_batch(data)
+    cluster_labels = winners[:, 0] * som.map_size[1] + winners[:, 1]
+    return silhouette_score(data, cluster_labels)
+
+
+def train_and_visualize(input_dim, map_size, feature_vectors, learning_rate, radius, epochs, output_directory):
     som = SOM(input_dim=input_dim, map_size=map_size, data=feature_vectors, learning_rate=learning_rate, radius=radius)
     som.train(feature_vectors, epochs)
 
-    # Extracting cluster centers from SOM weights
-    cluster_centers = np.array([som.weights[i, j] for i in range(som.map_size[0]) for j in range(som.map_size[1])])
-    samples_coords = np.array([som._find_winner(vec) for vec in feature_vectors])
-    samples = np.array(
-        [(coord[0] + np.random.normal(0, 0.2), coord[1] + np.random.normal(0, 0.2)) for coord in samples_coords])
-
-    fig, ax = plt.subplots(figsize=(10, 10))
+    # Extracting cluster centers from SOM weights (zero-copy view)
+    cluster_centers = som.weights.reshape(-1, som.input_dim)
+    samples_coords = som.find_winners_batch(feature_vectors)
+    samples = samples_coords.astype(float) + _rng.normal(0, 0.2, samples_coords.shape)
+
+    global _figure
+    if _figure is None:
+        _figure = plt.figure(figsize=(10, 10))
+    fig = _figure
+    fig.clf()  # Reuse the worker's figure instead of allocating one per call
+    ax = fig.add_subplot(111)
     visualize_som_clusters(cluster_centers, samples, ax)
     ax.set_title(f"Wspolczynnik uczenia: {learning_rate}, Promien: {radius}, Epoki: {epochs}", fontsize=12)
 
@@ -132,29 +319,27 @@ def train_and_visualize(params):
 
     filename = f"LR_{learning_rate}_Radius_{radius}_Epochs_{epochs}.png"
     filepath = os.path.join(output_directory, filename)
-    plt.savefig(filepath)
-
-    plt.close(fig)  # Close the figure after saving
+    fig.savefig(filepath)
 
 def visualize_som_results(map_size, feature_vectors, learning_rates, radii, epochs_list, output_directory="result"):
+    max_epochs = max(epochs_list)
     for lr in learning_rates:
         for r in radii:
+            # One SOM per (lr, radius); the epoch grid is rendered from weight
+            # snapshots of a single training run instead of retraining
+            som = SOM(input_dim=4, map_size=map_size, data=feature_vectors, learning_rate=lr, radius=r)
+            snapshots = som.train(feature_vectors, epochs=max_epochs, checkpoint_epochs=epochs_list)
             for ep in epochs_list:
-                # Training the SOM
-                som = SOM(input_dim=4, map_size=map_size, data=feature_vectors, learning_rate=lr, radius=r)
-                som.train(feature_vectors, epochs=ep)
+                som.weights = snapshots[ep]
 
-                # Extracting cluster centers from SOM weights
-                cluster_centers = np.array(
-                    [som.weights[i, j] for i in range(som.map_size[0]) for j in range(som.map_size[1])])
+                # Extracting cluster centers from SOM weights (zero-copy view)
+                cluster_centers = som.weights.reshape(-1, som.input_dim)
 
                 # Mapping feature vectors to the SOM to get their coordinates
-                samples_coords = np.array([som._find_winner(vec) for vec in feature_vectors])
+                samples_coords = som.find_winners_batch(feature_vectors)
 
                 # Convert samples_coords with a smaller jitter
-                samples = np.array(
-                    [(coord[0] + np.random.normal(0, 0.03), coord[1] + np.random.normal(0, 0.03)) for coord in
-                     samples_coords])
+                samples = samples_coords.astype(float) + _rng.normal(0, 0.03, samples_coords.shape)
 
                 # Plotting
                 fig, ax = plt.subplots(figsize=(10, 10))
@@ -176,6 +361,9 @@ def visualize_som_results(map_size, feature_vectors, learning_rates, radii, epoc
                 plt.close(fig)
 
 def main():
+    # Demo-only dependency; imported here so pool workers never pay for it
+    from src.plot import plot_images
+
     data_dir = "cifar-10-batches-py"
     car_images, edge_images, _ = load_and_preprocess_data(data_dir)
     plot_images(car_images, edge_images)
@@ -192,18 +380,23 @@ def main_parallel():
     data_dir = "cifar-10-batches-py"
     car_images, edge_images, _ = load_and_preprocess_data(data_dir)
     #edge images
-    edge_feature_vectors = np.array([extract_features_from_edge_image(img) for img in edge_images])
+    edge_feature_vectors = extract_features_from_edge_images(edge_images)
     edge_feature_vectors = edge_feature_vectors - np.mean(edge_feature_vectors, axis=0)
     edge_feature_vectors = edge_feature_vectors / np.std(edge_feature_vectors, axis=0)
-
-
-    # Get the number of available CPUs
-    num_processes = cpu_count()
-
-    with Pool(num_processes) as pool:
-        edge_params = itertools.product([4],[map_size], [edge_feature_vectors], learning_rates, radii, epochs_list,
-                                        [output_directory_edge])
-        pool.map(train_and_visualize, edge_params)
+    edge_feature_vectors = edge_feature_vectors.astype(np.float32)
+
+
+    # Only the small (lr, radius, epochs) tuples vary per task; joblib memmaps
+    # the shared feature array once instead of pickling it for every task
+    edge_params = list(itertools.product(learning_rates, radii, epochs_list))
+    if len(edge_params) == 1:
+        # Worker startup dominates for a single configuration; run it inline
+        lr, r, ep = edge_params[0]
+        train_and_visualize(4, map_size, edge_feature_vectors, lr, r, ep, output_directory_edge)
+    else:
+        Parallel(n_jobs=min(len(edge_params), cpu_count()), max_nbytes='1M', mmap_mode='r')(
+            delayed(train_and_visualize)(4, map_size, edge_feature_vectors, lr, r, ep, output_directory_edge)
+            for lr, r, ep in edge_params)
 
 
 if __name__ == "__main__":